@@ -1,59 +1,44 @@
 import os
 import io
+import re
 import streamlit as st
 import pandas as pd
 import numpy as np
 import plotly.express as px
 import plotly.graph_objects as go
-from datetime import datetime, timedelta
+from datetime import datetime
 
-st.set_page_config(layout="wide", page_title="Hepatitis B Forecasting")
+# bottleneck (optional) provides a C moving-window mean; pandas rolling is the fallback
+try:
+    import bottleneck as bn
+    HAS_BOTTLENECK = True
+except ImportError:
+    HAS_BOTTLENECK = False
 
-# Try to use centralized data_loader if present, otherwise fall back to built-in loaders
+# pyarrow (optional) writes CSV straight into a bytes buffer; pandas to_csv is the fallback
 try:
-    from data_loader import load_forecast_csv_path, load_forecast_filelike
-    HAS_DATA_LOADER = True
-except Exception:
-    HAS_DATA_LOADER = False
-
-    def _normalize_forecast_df(df: pd.DataFrame) -> pd.DataFrame:
-        df = df.rename(columns=lambda c: c.strip())
-        if "date" not in df.columns:
-            raise ValueError("No 'date' column found in forecast CSV.")
-        if not pd.api.types.is_datetime64_any_dtype(df["date"]):
-            df["date"] = pd.to_datetime(df["date"], errors="coerce")
-        df = df.sort_values("date").reset_index(drop=True)
-        if "predicted_median" not in df.columns:
-            raise ValueError("Missing required column 'predicted_median'.")
-        if "actual" not in df.columns:
-            df["actual"] = np.nan
-        if not ({"pi80_low", "pi80_high"} <= set(df.columns)):
-            pi80 = 1.5
-            df["pi80_low"] = df["predicted_median"] - pi80
-            df["pi80_high"] = df["predicted_median"] + pi80
-        if not ({"pi95_low", "pi95_high"} <= set(df.columns)):
-            pi95 = 3.0
-            df["pi95_low"] = df["predicted_median"] - pi95
-            df["pi95_high"] = df["predicted_median"] + pi95
-        return df
-
-    def load_forecast_csv_path(path: str) -> pd.DataFrame:
-        df = pd.read_csv(path, parse_dates=["date"], low_memory=False)
-        return _normalize_forecast_df(df)
-
-    def load_forecast_filelike(fobj: io.BytesIO) -> pd.DataFrame:
-        df = pd.read_csv(fobj, parse_dates=["date"])
-        return _normalize_forecast_df(df)
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.csv as pacsv
+    HAS_PYARROW = True
+except ImportError:
+    HAS_PYARROW = False
 
+st.set_page_config(layout="wide", page_title="Hepatitis B Forecasting")
+
+# Forecast CSV loading/validation lives in data_loader (single cached implementation)
+from data_loader import load_forecast_csv_path, load_forecast_filelike, read_csv_fast, to_arrow_backend
 
 # --- Data loaders / generators / specialized parsers ---
 
+@st.cache_data(ttl=300)
 def gen_forecast_data(start_date, days=60, horizon=14):
     """Fallback simulated data (kept for demo / fallback)."""
     dates = pd.date_range(start_date - pd.Timedelta(days=30), periods=days)
-    np.random.seed(42)
-    actual = np.clip(np.round(10 + np.sin(np.linspace(0, 3.14, days)) * 4 + np.random.randn(days)), 0, None)
-    predicted_median = actual + np.random.normal(0.5, 1.0, size=days)
+    # Local generator: no global RNG side effects, so the result is safe to cache
+    rng = np.random.default_rng(42)
+    actual = np.clip(np.round(10 + np.sin(np.linspace(0, 3.14, days)) * 4 + rng.standard_normal(days)), 0, None)
+    predicted_median = actual + rng.normal(0.5, 1.0, size=days)
     pi80 = 1.5
     pi95 = 3.0
     df = pd.DataFrame({
@@ -67,45 +52,80 @@ def gen_forecast_data(start_date, days=60, horizon=14):
     })
     return df
 
+def _rolling_mean(values: np.ndarray, window: int = 7) -> np.ndarray:
+    """Trailing mean over `window` values, ignoring NaNs (same as rolling(window, min_periods=1))."""
+    if HAS_BOTTLENECK:
+        return bn.move_mean(values, window, min_count=1)
+    return pd.Series(values).rolling(window, min_periods=1).mean().to_numpy()
+
 def gen_metrics(df):
-    df_metrics = df.copy()
+    """Return a narrow frame (date, error, MAE, RMSE); the forecast frame itself is not copied."""
     # If actuals are not available, error-based metrics will be NaN
-    df_metrics["error"] = (df_metrics["actual"] - df_metrics["predicted_median"]).abs()
-    df_metrics["MAE"] = df_metrics["error"].rolling(7, min_periods=1).mean()
-    df_metrics["RMSE"] = np.sqrt((df_metrics["error"]**2).rolling(7, min_periods=1).mean())
-    return df_metrics
+    err = np.abs(df["actual"].to_numpy(dtype=float) - df["predicted_median"].to_numpy(dtype=float))
+    mae = _rolling_mean(err)
+    rmse = np.sqrt(_rolling_mean(err * err))
+    return pd.DataFrame({
+        "date": df["date"].to_numpy(),
+        "error": err,
+        "MAE": mae,
+        "RMSE": rmse,
+    })
 
+@st.cache_data(ttl=300)
 def gen_patient_table(n=50):
-    np.random.seed(1)
-    base = []
-    for i in range(n):
-        date = datetime.now().date() - timedelta(days=np.random.randint(0,14))
-        prob = np.round(np.random.beta(2,5), 2)
-        base.append({
-            "patient_hash": f"sha256:{np.random.randint(10**8)}",
-            "date": date.isoformat(),
-            "predicted_risk": "high" if prob > 0.7 else ("medium" if prob>0.4 else "low"),
-            "probability": prob,
-            "top_feature_1": np.random.choice(["ALT","AST","HBsAg","Age","Platelets"]),
-            "top_feature_2": np.random.choice(["ALT","AST","HBsAg","Age","Platelets"]),
-        })
-    return pd.DataFrame(base)
+    rng = np.random.default_rng(1)
+    features = ["ALT","AST","HBsAg","Age","Platelets"]
+    risk_labels = np.array(["low","medium","high"])
+    # Draw every column in one vectorized call instead of looping per patient
+    probs = np.round(rng.beta(2, 5, n), 2)
+    days = rng.integers(0, 14, n)
+    dates = np.datetime64(datetime.now().date()) - days.astype("timedelta64[D]")
+    return pd.DataFrame({
+        "patient_hash": np.char.add("sha256:", rng.integers(0, 10**8, n).astype(str)),
+        "date": dates.astype(str),
+        # right=True keeps the strict thresholds: 0.4 -> low, 0.7 -> medium
+        "predicted_risk": risk_labels[np.digitize(probs, [0.4, 0.7], right=True)],
+        "probability": probs,
+        "top_feature_1": rng.choice(features, size=n),
+        "top_feature_2": rng.choice(features, size=n),
+    })
 
 # Specialized loader for monthly_forecast_2025_2029.csv
-def load_monthly_forecast(path: str) -> pd.DataFrame:
+@st.cache_data(ttl=300)
+def _read_monthly_csv(path, mtime: float = None) -> pd.DataFrame:
+    """Raw read of the monthly CSV. `mtime` is only used as part of the cache key."""
+    return read_csv_fast(path)
+
+def _is_numeric_like(col: pd.Series, sample: int = 100) -> bool:
+    """True if any value coerces to a number; a hit in the first `sample` rows skips the full scan."""
+    if pd.to_numeric(col.head(sample), errors="coerce").notna().any():
+        return True
+    return bool(pd.to_numeric(col.iloc[sample:], errors="coerce").notna().any())
+
+@st.cache_data(ttl=300)
+def _detect_columns(df: pd.DataFrame):
+    """Return (date_like, numeric_cols, numeric_like) candidate column lists for the sidebar."""
+    date_like = [c for c in df.columns if any(k in c.lower() for k in ("date","month","period","year"))]
+    numeric_cols = df.select_dtypes(include=[np.number]).columns.tolist()
+    # pyarrow may already have parsed ISO dates; keep them out of the numeric candidates
+    datetime_cols = df.select_dtypes(include=["datetime"]).columns.tolist()
+    # Also include numeric-like columns that may be strings (C-level coercion, no per-cell regex)
+    numeric_like = [c for c in df.columns if c not in numeric_cols and c not in datetime_cols
+                    and _is_numeric_like(df[c])]
+    return date_like, numeric_cols, numeric_like
+
+def load_monthly_forecast(path, mtime: float = None) -> pd.DataFrame:
     """
     Load monthly_forecast_2025_2029.csv and normalize to columns:
       - date (datetime, first of month)
       - predicted_median (numeric)
       - optional: actual, pi80_low/high, pi95_low/high
     The function will try to autodetect date-like and numeric columns and let the user confirm via sidebar if multiple choices exist.
+    Widgets live here (uncached); reading and parsing are cached separately.
     """
-    df = pd.read_csv(path, low_memory=False)
+    df = _read_monthly_csv(path, mtime)
     # Detect date-like columns and numeric columns
-    date_like = [c for c in df.columns if any(k in c.lower() for k in ("date","month","period","year"))]
-    numeric_cols = df.select_dtypes(include=[np.number]).columns.tolist()
-    # Also include numeric-like columns that may be strings
-    numeric_like = [c for c in df.columns if c not in numeric_cols and df[c].astype(str).str.replace(r'[^\d\.\-]', '', regex=True).str.len().gt(0).any()]
+    date_like, numeric_cols, numeric_like = _detect_columns(df)
 
     # Provide feedback in sidebar and allow user mapping
     st.sidebar.markdown("### monthly_forecast_2025_2029.csv detected columns")
@@ -123,49 +143,134 @@ def load_monthly_forecast(path: str) -> pd.DataFrame:
     if not candidate_value_cols:
         raise ValueError("No numeric columns found to use as predicted_median.")
     value_col = st.sidebar.selectbox("Select value column to use as predicted_median", candidate_value_cols, index=0)
+    return _parse_monthly(df, date_col, value_col)
+
+def _sniff_date_format(col: pd.Series):
+    """Guess a strftime format from the first non-null value (YYYY-MM or YYYY-MM-DD), else None."""
+    non_null = col.dropna()
+    if non_null.empty:
+        return None
+    first = str(non_null.iloc[0]).strip()
+    if re.fullmatch(r"\d{4}-\d{2}", first):
+        return "%Y-%m"
+    if re.fullmatch(r"\d{4}-\d{2}-\d{2}", first):
+        return "%Y-%m-%d"
+    return None
 
-    # Parse dates: if entries look like YYYY-MM, append -01
-    series = pd.to_datetime(df[date_col], errors="coerce")
-    if series.isna().all():
-        # try adding day=1 to year-month strings
-        series = pd.to_datetime(df[date_col].astype(str).str.strip() + "-01", errors="coerce")
-    # final fallback: use index with monthly spacing starting from today - len
-    if series.isna().any():
-        # try resilient parsing: coerce and drop NA rows later
-        series = pd.to_datetime(df[date_col], errors="coerce")
+def _parse_date_column(col: pd.Series) -> pd.Series:
+    """Convert a date/month column with one to_datetime call; YYYY-MM maps to the first of the month."""
+    if pd.api.types.is_datetime64_any_dtype(col):
+        return col
+    fmt = _sniff_date_format(col)
+    if fmt == "%Y-%m":
+        # year-month strings: append day=1 so every row parses with the same exact format
+        return pd.to_datetime(col.astype(str).str.strip() + "-01", format="%Y-%m-%d", cache=True, errors="coerce")
+    if fmt is not None:
+        return pd.to_datetime(col, format=fmt, cache=True, errors="coerce")
+    return pd.to_datetime(col, cache=True, errors="coerce")
+
+@st.cache_data(ttl=300)
+def _parse_monthly(df: pd.DataFrame, date_col: str, value_col: str) -> pd.DataFrame:
+    """Normalize the raw monthly frame using the user-selected date/value columns."""
+    # Parse dates in a single pass; unparseable rows are coerced to NaT and dropped later
+    series = _parse_date_column(df[date_col])
 
     out = pd.DataFrame({
         "date": series,
-        "predicted_median": pd.to_numeric(df[value_col], errors="coerce")
+        # float32 is plenty for case counts and halves the bytes moved through PI arithmetic/plotting
+        "predicted_median": pd.to_numeric(df[value_col], errors="coerce").astype("float32")
     })
 
     # Optional actual detection
     possible_actual = [c for c in df.columns if any(k in c.lower() for k in ("actual","observed","obs","report"))]
     if possible_actual:
-        out["actual"] = pd.to_numeric(df[possible_actual[0]], errors="coerce")
+        out["actual"] = pd.to_numeric(df[possible_actual[0]], errors="coerce").astype("float32")
     else:
-        out["actual"] = np.nan
+        out["actual"] = np.float32(np.nan)
 
     # Add simple PIs if not present in original file
     if "pi80_low" not in out.columns:
         sigma = out["predicted_median"].std(skipna=True)
-        pi80 = sigma if not np.isnan(sigma) and sigma > 0 else 1.5
+        pi80 = sigma if not pd.isna(sigma) and sigma > 0 else 1.5
         out["pi80_low"] = out["predicted_median"] - pi80
         out["pi80_high"] = out["predicted_median"] + pi80
     if "pi95_low" not in out.columns:
         sigma = out["predicted_median"].std(skipna=True)
-        pi95 = 2 * (sigma if not np.isnan(sigma) and sigma > 0 else 3.0)
+        pi95 = 2 * (sigma if not pd.isna(sigma) and sigma > 0 else 3.0)
         out["pi95_low"] = out["predicted_median"] - pi95
         out["pi95_high"] = out["predicted_median"] + pi95
 
     out = out.dropna(subset=["date"]).sort_values("date").reset_index(drop=True)
-    return out
+    return to_arrow_backend(out)
+
+# --- Figures ---
+
+def _hash_frame(df: pd.DataFrame) -> bytes:
+    """Cache key for a DataFrame: row hashes of its full contents, including the index."""
+    return pd.util.hash_pandas_object(df, index=True).values.tobytes()
+
+# Figures are resources (not serializable data), so cache them with cache_resource
+@st.cache_resource(ttl=300, hash_funcs={pd.DataFrame: _hash_frame})
+def build_forecast_fig(df_forecast: pd.DataFrame, show_pi80: bool = False) -> go.Figure:
+    """Forecast chart: predicted median, optional actuals, the 95% PI ribbon and (optionally) the 80% one."""
+    # Pass ndarrays (not Series) to Plotly so serialization skips the pandas index.
+    # Ribbon x-coordinates (dates forward then back) are shared by both PI bands; build once
+    dates = df_forecast["date"].to_numpy()
+    x_ribbon = np.concatenate([dates, dates[::-1]])
+    fig = go.Figure()
+    fig.add_trace(go.Scatter(
+        x=dates, y=df_forecast["predicted_median"].to_numpy(),
+        mode="lines+markers", name="Predicted median"
+    ))
+    if "actual" in df_forecast.columns and df_forecast["actual"].notna().any():
+        fig.add_trace(go.Scatter(
+            x=dates, y=df_forecast["actual"].to_numpy(),
+            mode="lines+markers", name="Actual"
+        ))
+    # PI ribbons (guard against missing values)
+    if all(c in df_forecast.columns for c in ("pi95_high","pi95_low")):
+        y95 = np.concatenate([df_forecast["pi95_high"].to_numpy(), df_forecast["pi95_low"].to_numpy()[::-1]])
+        fig.add_traces([
+            go.Scatter(
+                x=x_ribbon, y=y95,
+                fill='toself', fillcolor='rgba(200,200,255,0.2)',
+                line=dict(color='rgba(255,255,255,0)'), showlegend=False, name="95% PI"
+            )
+        ])
+    if show_pi80 and all(c in df_forecast.columns for c in ("pi80_high","pi80_low")):
+        y80 = np.concatenate([df_forecast["pi80_high"].to_numpy(), df_forecast["pi80_low"].to_numpy()[::-1]])
+        fig.add_traces([
+            go.Scatter(
+                x=x_ribbon, y=y80,
+                fill='toself', fillcolor='rgba(150,150,255,0.4)',
+                line=dict(color='rgba(255,255,255,0)'), showlegend=False, name="80% PI"
+            )
+        ])
+    fig.update_layout(height=500, xaxis_title="Date", yaxis_title="Count / Score")
+    return fig
+
+# --- Export ---
+
+def forecast_csv_bytes(df: pd.DataFrame) -> bytes:
+    """Encode the forecast frame as CSV bytes with dates written as YYYY-MM-DD."""
+    if not HAS_PYARROW:
+        return df.to_csv(index=False, date_format="%Y-%m-%d").encode("utf-8")
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    if "date" in table.column_names and pa.types.is_timestamp(table.schema.field("date").type):
+        # date32 is written as YYYY-MM-DD, matching the pandas date_format
+        i = table.column_names.index("date")
+        table = table.set_column(i, "date", pc.cast(table["date"], pa.date32(), safe=False))
+    buf = io.BytesIO()
+    pacsv.write_csv(table, buf)
+    return buf.getvalue()
 
 # --- UI Controls ---
 st.sidebar.title("Controls")
 horizon = st.sidebar.selectbox("Forecast horizon (days)", [7, 14, 30], index=1)
 cohort = st.sidebar.selectbox("Cohort", ["All", "Adults 18-45", "Adults 46+", "Pediatrics"], index=0)
 model_version = st.sidebar.selectbox("Model version", ["v1.0", "v1.1", "experimental"], index=1)
+# Off by default: the second ribbon doubles the polygon vertices sent to the browser
+show_pi80 = st.sidebar.checkbox("Show 80% PI", value=False)
 start_date = datetime.now().date()
 
 # Data source selection
@@ -192,32 +297,20 @@ load_error = None
 
 if uploaded_file is not None:
     try:
-        if HAS_DATA_LOADER:
-            df_forecast = load_forecast_filelike(uploaded_file)
-        else:
-            uploaded_name = getattr(uploaded_file, "name", "").lower()
-            uploaded_file.seek(0)
-            # if filename suggests monthly forecast, use specialized parser
-            if "monthly" in uploaded_name or "forecast" in uploaded_name or "2025" in uploaded_name:
-                uploaded_file.seek(0)
-                # read into temp file on string IO for the specialized loader
-                s = uploaded_file.getvalue().decode("utf-8", errors="ignore")
-                df_forecast = load_monthly_forecast(io.StringIO(s))
-            else:
-                uploaded_file.seek(0)
-                df_forecast = load_forecast_filelike(uploaded_file)
+        df_forecast = load_forecast_filelike(uploaded_file)
     except Exception as e:
         load_error = f"Uploaded CSV error: {e}"
 elif use_repo_csv:
     try:
         # If the chosen repo CSV matches the monthly filename, use the specialized loader
-        if os.path.basename(repo_csv_path).lower().startswith("monthly") or "monthly" in os.path.basename(repo_csv_path).lower():
-            df_forecast = load_monthly_forecast(repo_csv_path)
+        # mtime keys the loader caches so edits to the CSV invalidate them
+        repo_csv_mtime = os.path.getmtime(repo_csv_path)
+        base = os.path.basename(repo_csv_path).lower()
+        is_monthly = "monthly" in base
+        if is_monthly:
+            df_forecast = load_monthly_forecast(repo_csv_path, repo_csv_mtime)
         else:
-            if HAS_DATA_LOADER:
-                df_forecast = load_forecast_csv_path(repo_csv_path)
-            else:
-                df_forecast = load_forecast_csv_path(repo_csv_path)
+            df_forecast = load_forecast_csv_path(repo_csv_path, repo_csv_mtime)
     except Exception as e:
         load_error = f"Error loading {repo_csv_path}: {e}"
 
@@ -238,36 +331,7 @@ col1, col2 = st.columns([3,1])
 
 with col1:
     st.subheader("Forecast over time")
-    fig = go.Figure()
-    fig.add_trace(go.Scatter(
-        x=df_forecast["date"], y=df_forecast["predicted_median"],
-        mode="lines+markers", name="Predicted median"
-    ))
-    if "actual" in df_forecast.columns and df_forecast["actual"].notna().any():
-        fig.add_trace(go.Scatter(
-            x=df_forecast["date"], y=df_forecast["actual"],
-            mode="lines+markers", name="Actual"
-        ))
-    # PI ribbons (guard against missing values)
-    if all(c in df_forecast.columns for c in ("pi95_high","pi95_low")):
-        fig.add_traces([
-            go.Scatter(
-                x=pd.concat([df_forecast["date"], df_forecast["date"][::-1]]),
-                y=pd.concat([df_forecast["pi95_high"], df_forecast["pi95_low"][::-1]]),
-                fill='toself', fillcolor='rgba(200,200,255,0.2)',
-                line=dict(color='rgba(255,255,255,0)'), showlegend=False, name="95% PI"
-            )
-        ])
-    if all(c in df_forecast.columns for c in ("pi80_high","pi80_low")):
-        fig.add_traces([
-            go.Scatter(
-                x=pd.concat([df_forecast["date"], df_forecast["date"][::-1]]),
-                y=pd.concat([df_forecast["pi80_high"], df_forecast["pi80_low"][::-1]]),
-                fill='toself', fillcolor='rgba(150,150,255,0.4)',
-                line=dict(color='rgba(255,255,255,0)'), showlegend=False, name="80% PI"
-            )
-        ])
-    fig.update_layout(height=500, xaxis_title="Date", yaxis_title="Count / Score")
+    fig = build_forecast_fig(df_forecast, show_pi80)
     st.plotly_chart(fig, use_container_width=True)
 
 with col2:
@@ -283,7 +347,5 @@ st.dataframe(df_patients.head(20))
 
 # Optional: allow downloading a cleaned/validated CSV
 if st.button("Download validated forecast CSV"):
-    buf = df_forecast.copy()
-    buf["date"] = pd.to_datetime(buf["date"]).dt.strftime("%Y-%m-%d")
-    csv = buf.to_csv(index=False).encode("utf-8")
+    csv = forecast_csv_bytes(df_forecast)
     st.download_button("Download CSV", data=csv, file_name="validated_forecast.csv", mime="text/csv")
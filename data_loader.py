@@ -6,31 +6,63 @@ Intended to be imported from app.py. Uses pandas and numpy only.
 from typing import Optional
 import os
 import io
+import hashlib
 import pandas as pd
 import numpy as np
 import streamlit as st
 
 REQUIRED_FORECAST_COLS = {"date", "predicted_median"}
 OPTIONAL_PI_COLS = {"pi80_low", "pi80_high", "pi95_low", "pi95_high", "actual"}
+# Case counts fit comfortably in float32; halves memory traffic for PI arithmetic and plotting
+FORECAST_FLOAT_COLS = ("predicted_median", "actual", "pi80_low", "pi80_high", "pi95_low", "pi95_high")
+
+def _hash_buffer(b: io.BytesIO) -> bytes:
+    """Cache key for in-memory uploads: digest of the full buffer contents."""
+    return hashlib.md5(b.getvalue()).digest()
+
+# Uploaded files are BytesIO subclasses; Streamlit matches hash_funcs on the exact type
+BUFFER_HASH_FUNCS = {
+    io.BytesIO: _hash_buffer,
+    "streamlit.runtime.uploaded_file_manager.UploadedFile": _hash_buffer,
+}
+
+def _stable_hash(values: pd.Series, length: int = 12) -> pd.Series:
+    """Truncated sha256 hex digest per value; unlike hash(), stable across processes and workers."""
+    ids = values.astype(str).to_numpy()
+    hashes = [hashlib.sha256(x.encode()).hexdigest()[:length] for x in ids]
+    return pd.Series(hashes, index=values.index)
+
+def read_csv_fast(src, parse_dates: Optional[list] = None) -> pd.DataFrame:
+    """Read a CSV with the pyarrow engine when installed, else the C engine with cache_dates."""
+    try:
+        return pd.read_csv(src, engine="pyarrow", parse_dates=parse_dates)
+    except ImportError:
+        return pd.read_csv(src, engine="c", parse_dates=parse_dates, cache_dates=True, low_memory=False)
 
 @st.cache_data(ttl=300)
-def load_forecast_csv_path(path: str, anonymize: bool = False) -> pd.DataFrame:
-    """Load and normalize a forecast CSV on disk (path)."""
+def load_forecast_csv_path(path: str, mtime: Optional[float] = None, anonymize: bool = False) -> pd.DataFrame:
+    """Load and normalize a forecast CSV on disk (path).
+
+    `mtime` is only part of the cache key: pass os.path.getmtime(path) so edits to
+    the file invalidate the cached frame.
+    """
     if not os.path.exists(path):
         raise FileNotFoundError(f"Forecast CSV not found: {path}")
-    df = pd.read_csv(path, parse_dates=["date"])
+    df = read_csv_fast(path, parse_dates=["date"])
     return _normalize_forecast_df(df, anonymize=anonymize)
 
-@st.cache_data(ttl=300)
+@st.cache_data(ttl=300, hash_funcs=BUFFER_HASH_FUNCS)
 def load_forecast_filelike(file_like: io.BytesIO, anonymize: bool = False) -> pd.DataFrame:
     """Load and normalize a forecast CSV from an uploaded file (BytesIO)."""
-    df = pd.read_csv(file_like, parse_dates=["date"])
+    file_like.seek(0)
+    df = read_csv_fast(file_like, parse_dates=["date"])
     return _normalize_forecast_df(df, anonymize=anonymize)
 
 def _normalize_forecast_df(df: pd.DataFrame, anonymize: bool = False) -> pd.DataFrame:
     """Ensure required columns, add safe defaults for optional columns, and return sorted df."""
-    # Normalize column names
-    df = df.rename(columns=lambda c: c.strip())
+    # Normalize column names (skip the renamer when nothing needs stripping)
+    if any(c != c.strip() for c in df.columns):
+        df = df.rename(columns=lambda c: c.strip())
     cols = set(df.columns)
 
     missing = REQUIRED_FORECAST_COLS - cols
@@ -43,22 +75,34 @@ def _normalize_forecast_df(df: pd.DataFrame, anonymize: bool = False) -> pd.Data
     df = df.sort_values("date").reset_index(drop=True)
 
     # Add optional columns if missing
-    if "actual" not in df.columns:
+    if "actual" not in cols:
         df["actual"] = np.nan
-    if not ({"pi80_low","pi80_high"} <= set(df.columns)):
+    # Cast before deriving PIs so the arithmetic below runs in float32
+    for c in FORECAST_FLOAT_COLS:
+        if c in df.columns:
+            df[c] = df[c].astype("float32", copy=False)
+    if not ({"pi80_low","pi80_high"} <= cols):
         pi80 = 1.5
         df["pi80_low"] = df["predicted_median"] - pi80
         df["pi80_high"] = df["predicted_median"] + pi80
-    if not ({"pi95_low","pi95_high"} <= set(df.columns)):
+    if not ({"pi95_low","pi95_high"} <= cols):
         pi95 = 3.0
         df["pi95_low"] = df["predicted_median"] - pi95
         df["pi95_high"] = df["predicted_median"] + pi95
 
     # Optional anonymization placeholder
-    if anonymize and "patient_id" in df.columns:
-        df["patient_id"] = df["patient_id"].apply(lambda v: f"anon_{abs(hash(str(v)))%10_000_000}")
+    if anonymize and "patient_id" in cols:
+        df["patient_id"] = "anon_" + _stable_hash(df["patient_id"])
 
-    return df
+    return to_arrow_backend(df)
+
+def to_arrow_backend(df: pd.DataFrame) -> pd.DataFrame:
+    """Convert to pyarrow-backed dtypes; returns df unchanged if pandas/pyarrow cannot."""
+    try:
+        # convert_integer=False keeps whole-valued forecast columns as floats
+        return df.convert_dtypes(dtype_backend="pyarrow", convert_integer=False)
+    except (TypeError, ImportError):
+        return df
 
 def load_patient_csv_path(path: str, anonymize: bool = True) -> pd.DataFrame:
     """Load patient CSV and optionally anonymize sensitive columns."""
@@ -82,6 +126,6 @@ def _normalize_patient_df(df: pd.DataFrame, anonymize: bool = True) -> pd.DataFr
             if phi in df.columns:
                 df[phi] = df[phi].apply(lambda v: None)
         if "patient_id" in df.columns:
-            df["patient_hash"] = df["patient_id"].apply(lambda v: f"sha256:{abs(hash(str(v)))%10_000_000}")
+            df["patient_hash"] = "sha256:" + _stable_hash(df["patient_id"])
             df = df.drop(columns=["patient_id"])
     return df